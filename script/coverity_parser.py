@@ -6,12 +6,32 @@
 #
 
 import argparse
-import collections
+import functools
 import json
-import re
-import shutil
 import sys
 
+# ijson is not a standard library package. When available, use it to stream
+# issue groups out of the report rather than loading the whole report (which
+# can be hundreds of megabytes) into memory. Only its C backend is worth using:
+# the pure Python backends are many times slower than loading the whole report,
+# so if the C backend can't be imported, load the report instead.
+try:
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    ijson = None
+
+# Similarly, use orjson if it's available, to load the report when it can't be
+# streamed, and to write out the selected issues.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    _json_dumps = orjson.dumps
+else:
+    def _json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
 
 # Ignore some directories, as they're imported from other projects. Their
 # code style is not necessarily the same as ours, and enforcing our rules
@@ -26,7 +46,10 @@ IGNORED_DIRS = [
     "include/lib/zlib",
 ]
 
-_rule_exclusions = [
+# str.startswith() accepts a tuple of prefixes
+_IGNORED_DIRS_TUPLE = tuple(IGNORED_DIRS)
+
+_rule_exclusions = frozenset([
     "MISRA C-2012 Rule 2.4",
     "MISRA C-2012 Rule 2.5",
     "MISRA C-2012 Rule 2.7",
@@ -46,25 +69,25 @@ _rule_exclusions = [
     "MISRA C-2012 Directive 4.6",
     "MISRA C-2012 Directive 4.8",
     "MISRA C-2012 Directive 4.9"
-]
+])
 
 # The following classification of rules and directives include 'MISRA C:2012
 # Amendment 1'
 
 # Directives
-_dir_required = set(["1.1", "2.1", "3.1", "4.1", "4.3", "4.7", "4.10", "4.11",
-    "4.12", "4.14"])
+_dir_required = frozenset(["1.1", "2.1", "3.1", "4.1", "4.3", "4.7", "4.10",
+    "4.11", "4.12", "4.14"])
 
-_dir_advisory = set(["4.2", "4.4", "4.5", "4.6", "4.8", "4.9", "4.13"])
+_dir_advisory = frozenset(["4.2", "4.4", "4.5", "4.6", "4.8", "4.9", "4.13"])
 
 # Rules
-_rule_mandatory = set(["9.1", "9.2", "9.3", "12.5", "13.6", "17.3", "17.4",
-    "17.6", "19.1", "21.13", "21.17", "21.18", "21.19", "21.20", "22.2", "22.5",
-    "22.6"])
+_rule_mandatory = frozenset(["9.1", "9.2", "9.3", "12.5", "13.6", "17.3",
+    "17.4", "17.6", "19.1", "21.13", "21.17", "21.18", "21.19", "21.20", "22.2",
+    "22.5", "22.6"])
 
-_rule_required = set(["1.1", "1.3", "2.1", "2.2", "3.1", "3.2", "4.1", "5.1",
-    "5.2", "5.3", "5.4", "5.5", "5.6", "5.7", "5.8", "6.1", "6.2", "7.1", "7.2",
-    "7.3", "7.4", "8.1", "8.2", "8.3", "8.4", "8.5", "8.6", "8.7", "8.8",
+_rule_required = frozenset(["1.1", "1.3", "2.1", "2.2", "3.1", "3.2", "4.1",
+    "5.1", "5.2", "5.3", "5.4", "5.5", "5.6", "5.7", "5.8", "6.1", "6.2", "7.1",
+    "7.2", "7.3", "7.4", "8.1", "8.2", "8.3", "8.4", "8.5", "8.6", "8.7", "8.8",
     "8.10", "8.12", "8.14", "9.2", "9.3", "9.4", "9.5", "10.1", "10.2", "10.3",
     "10.4", "10.6", "10.7", "10.8", "11.1", "11.2", "11.3", "11.6", "11.7",
     "11.8", "11.9", "12.2", "13.1", "13.2", "13.5", "14.1", "14.2", "14.3",
@@ -75,10 +98,10 @@ _rule_required = set(["1.1", "1.3", "2.1", "2.2", "3.1", "3.2", "4.1", "5.1",
     "21.6", "21.7", "21.8", "21.9", "21.10", "21.11", "21.14", "21.15", "21.16",
     "22.1", "22.3", "22.4", "22.7", "22.8", "22.9", "22.10"])
 
-_rule_advisory = set(["1.2", "2.3", "2.4", "2.5", "2.6", "2.7", "4.2", "5.9",
-    "8.9", "8.11", "8.13", "10.5", "11.4", "11.5", "12.1", "12.3", "12.4",
-    "13.3", "13.4", "15.1", "15.4", "15.5", "17.5", "17.8", "18.4", "18.5",
-    "19.2", "20.1", "20.2", "20.5", "20.10", "21.12"])
+_rule_advisory = frozenset(["1.2", "2.3", "2.4", "2.5", "2.6", "2.7", "4.2",
+    "5.9", "8.9", "8.11", "8.13", "10.5", "11.4", "11.5", "12.1", "12.3",
+    "12.4", "13.3", "13.4", "15.1", "15.4", "15.5", "17.5", "17.8", "18.4",
+    "18.5", "19.2", "20.1", "20.2", "20.5", "20.10", "21.12"])
 
 
 _checker_lookup = {
@@ -93,60 +116,110 @@ _checker_lookup = {
         }
     }
 
-_checker_re = re.compile(r"""(?P<kind>\w+) (?P<number>[\d\.]+)$""")
-
+# Flattened form of _checker_lookup, mapping each number straight to its
+# classification. Some numbers appear in more than one set (e.g. Rule 9.2); the
+# first classification listed in _checker_lookup takes precedence.
+_flat_lookup = {
+        kind: {number: classification
+            for classification, class_set in reversed(list(classes.items()))
+            for number in class_set}
+        for kind, classes in _checker_lookup.items()
+    }
 
+# There are only a handful of distinct checkers in a scan, but this is called
+# for every issue group and every event; cache the results.
+@functools.lru_cache(maxsize=None)
 def _classify_checker(checker):
-    match = _checker_re.search(checker)
-    if match:
-        kind, number = match.group("kind"), match.group("number")
-        for classification, class_set in _checker_lookup[kind].items():
-            if number in class_set:
-                return classification
+    # Checker names end in "<kind> <number>", e.g. "MISRA C-2012 Rule 8.4"
+    parts = checker.rsplit(" ", 2)
+    if len(parts) < 2:
+        return "unknown"
 
-    return "unknown"
+    kind, number = parts[-2], parts[-1]
+    return _flat_lookup.get(kind, {}).get(number, "unknown")
 
 
 # Return a copy of the original issue description. Update file path to strip
 # heading '/', and also insert CID.
-def _new_issue(cid, orig_issue):
-    checker = orig_issue["checker"]
-    classification = _classify_checker(checker)
+def _new_issue(cid, orig_issue, classification):
+    path = orig_issue["file"]
+    if path[:1] == "/":
+        path = path[1:]
 
     return {
         "cid": cid,
-        "file": orig_issue["file"].lstrip("/"),
+        "file": path,
         "line": orig_issue["mainEventLineNumber"],
-        "checker": checker,
+        "checker": orig_issue["checker"],
         "classification": classification,
         "description": orig_issue["mainEventDescription"]
     }
 
-def _new_issue_v7(cid, checker, issue):
+def _new_issue_v7(cid, checker, classification, issue):
     return {
         "cid": cid,
         "file": issue["strippedFilePathname"],
         "line": issue["lineNumber"],
         "checker": checker,
-        "classification": _classify_checker(checker),
+        "classification": classification,
         "description": issue["eventDescription"],
     }
 
 
+# Strings to show for each classification, and HTML classes to use for them
+_CLS_STRING_CACHE = {
+        "mandatory": " (mandatory)",
+        "required": " (required)",
+        "advisory": " (advisory)",
+        "unknown": ""
+    }
+
+_COV_CLASS_CACHE = {cls: "cov-" + cls for cls in _CLS_STRING_CACHE}
+
+
 def _cls_string(issue):
-    cls = issue["classification"]
+    return _CLS_STRING_CACHE[issue["classification"]]
+
 
-    return " (" + cls + ")" if cls != "unknown" else ""
+_NO_CID = float("inf")
 
 
-# Given an issue, make a string formed of file name, line number, checker, and
+# Given an issue, make a tuple formed of file name, line number, checker, and
 # the CID. This could be used as a dictionary key to identify unique defects
-# across the scan. Convert inegers to zero-padded strings for proper sorting.
+# across the scan, and sorts by each of those fields in turn. Issues from a v7
+# report may have no CID; sort those after the ones that do.
 def make_key(i):
-    return (i["file"] + str(i["line"]).zfill(5) + i["checker"] +
-            str(i["cid"]).zfill(5))
-
-
+    cid = i["cid"]
+    return (i["file"], i["line"], i["checker"], _NO_CID if cid is None else cid)
+
+
+def _filter_groups_v1(group, show_all):
+    """Decide if we should keep an issue group from a v1-6 format dict"""
+    # Tests are ordered cheapest first. Unless we're showing all groups, remove
+    # the groups that are in both golden and branch.
+    if not show_all and group["presentInComparisonSnapshot"]:
+        return False
+    if group["triage"]["action"] == "Ignore":
+        return False
+    first = group["occurrences"][0]
+    if first["checker"] in _rule_exclusions:
+        return False
+    path = first["file"]
+    if path[:1] == "/":
+        path = path[1:]
+    if path.startswith(_IGNORED_DIRS_TUPLE):
+        return False
+    return True
+
+
+def _filter_groups_v7(group):
+    """Decide if we should keep an issue group from a v7 format dict"""
+    if group.get("checker_name") in _rule_exclusions:
+        return False
+    path = group["strippedMainEventFilePathname"]
+    if path.startswith(_IGNORED_DIRS_TUPLE):
+        return False
+    return True
 
 
 class Issues(object):
@@ -160,86 +233,107 @@ class Issues(object):
         self.path = path
         self.show_all = show_all
         self.iterated = False
-        self.totals = collections.defaultdict(int)
+        self.totals = {"mandatory": 0, "required": 0, "advisory": 0,
+                "unknown": 0, "total": 0}
         self.gen = None
 
-    def filter_groups_v1(self, group):
-        """Decide if we should keep an issue group from a v1-6 format dict"""
-        if group["triage"]["action"] == "Ignore":
-            return False
-        if group["occurrences"][0]["checker"] in _rule_exclusions:
-            return False
-        for skip_dir in IGNORED_DIRS:
-            if group["occurrences"][0]["file"].lstrip("/").startswith(skip_dir):
-                return False
-        # unless we're showing all groups, remove the groups that are in both
-        # golden and branch
-        if not self.show_all:
-            return not group["presentInComparisonSnapshot"]
-        return True
-
-    def iter_issues_v1(self, report):
+    def iter_issues_v1(self, groups):
+        totals = self.totals
+        show_all = self.show_all
         # Top-level is a group of issues, all sharing a common CID
-        for issue_group in filter(self.filter_groups_v1, report["issueInfo"]):
+        for issue_group in groups:
+            if not _filter_groups_v1(issue_group, show_all):
+                continue
+            cid = issue_group["cid"]
+            occurrences = issue_group["occurrences"]
+            cls = _classify_checker(occurrences[0]["checker"])
+            totals[cls] += 1
+            totals["total"] += 1
             # Pick up individual occurrence of the CID
-            self.totals[_classify_checker(occurrence["checkerName"])] += 1
-            self.totals["total"] += 1
-            for occurrence in issue_group["occurrences"]:
-                yield _new_issue(issue_group["cid"], occurrence)
-
-    def filter_groups_v7(self, group):
-        """Decide if we should keep an issue group from a v7 format dict"""
-        if group.get("checker_name") in _rule_exclusions:
-            return False
-        for skip_dir in IGNORED_DIRS:
-            if group["strippedMainEventFilePathname"].startswith(skip_dir):
-                return False
-        return True
-
-    def iter_issues_v7(self, report):
+            for occurrence in occurrences:
+                yield _new_issue(cid, occurrence, cls)
+
+    def iter_issues_v7(self, groups):
+        totals = self.totals
         # TODO: filter by triage and action
-        for issue_group in filter(self.filter_groups_v7, report["issues"]):
-            self.totals[_classify_checker(issue_group["checkerName"])] += 1
-            self.totals["total"] += 1
+        for issue_group in groups:
+            if not _filter_groups_v7(issue_group):
+                continue
+            cid = issue_group.get("cid")
+            checker = issue_group["checkerName"]
+            cls = _classify_checker(checker)
+            totals[cls] += 1
+            totals["total"] += 1
             for event in issue_group["events"]:
-                yield _new_issue_v7(
-                    issue_group.get("cid"),
-                    issue_group["checkerName"],
-                    event
-                )
+                yield _new_issue_v7(cid, checker, cls, event)
+
+    def _stream_groups(self, prefix):
+        """Yield issue groups one at a time from the array at prefix"""
+        with open(self.path, "rb") as fd:
+            yield from ijson.items(fd, prefix)
 
     def _gen(self):
-        with open(self.path, encoding="utf-8") as fd:
-            report = json.load(fd)
-        if report.get("formatVersion", 0) >= 7:
-            return self.iter_issues_v7(report)
+        if ijson is None:
+            if orjson is not None:
+                with open(self.path, "rb") as fd:
+                    report = orjson.loads(fd.read())
+            else:
+                with open(self.path, encoding="utf-8") as fd:
+                    report = json.load(fd)
+            if report.get("formatVersion", 0) >= 7:
+                return self.iter_issues_v7(report["issues"])
+            else:
+                return self.iter_issues_v1(report["issueInfo"])
+
+        # Note that if the report has no top-level formatVersion, this parses
+        # the whole file before falling back to the default.
+        with open(self.path, "rb") as fd:
+            version = next(ijson.items(fd, "formatVersion"), 0)
+        if version >= 7:
+            return self.iter_issues_v7(self._stream_groups("issues.item"))
         else:
-            return self.iter_issues_v1(report)
+            return self.iter_issues_v1(self._stream_groups("issueInfo.item"))
 
     def __iter__(self):
         if self.gen is None:
             self.gen = self._gen()
         yield from self.gen
 
-# Format issue (returned from iter_issues()) as text.
-def format_issue(issue):
-    return ("{file}:{line}:[{checker}{cls}]<{cid}> {description}").format_map(
-            dict(issue, cls=_cls_string(issue)))
 
+_TXT_FMT = "{file}:{line}:[{checker}{cls}]<{cid}> {description}".format_map
 
-# Format issue (returned from iter_issues()) as HTML table row.
-def format_issue_html(issue):
-    cls = _cls_string(issue)
-    cov_class = "cov-" + issue["classification"]
-
-    return """\
+_HTML_FMT = """\
 <tr class="{cov_class}">
   <td class="cov-file">{file}</td>
   <td class="cov-line">{line}</td>
   <td class="cov-checker">{checker}{cls}</td>
   <td class="cov-cid">{cid}</td>
   <td class="cov-description">{description}</td>
-</tr>""".format_map(dict(issue, cls=cls, cov_class=cov_class))
+</tr>""".format_map
+
+
+# Format issue (returned from iter_issues()) as text.
+def format_issue(issue):
+    return _TXT_FMT({**issue, "cls": _cls_string(issue)})
+
+
+# Format issue (returned from iter_issues()) as HTML table row.
+def format_issue_html(issue):
+    cls = _cls_string(issue)
+    cov_class = _COV_CLASS_CACHE[issue["classification"]]
+
+    return _HTML_FMT({**issue, "cls": cls, "cov_class": cov_class})
+
+
+# Write issues to a binary file as a JSON array. Issues are serialised one at a
+# time so that the whole array is never held in memory as a single string.
+def dump_issues(fd, issues):
+    fd.write(b"[")
+    for n, issue in enumerate(issues):
+        if n:
+            fd.write(b",")
+        fd.write(_json_dumps(issue))
+    fd.write(b"]")
 
 
 TOTALS_FORMAT = str.strip("""
@@ -263,18 +357,29 @@ if __name__ == "__main__":
     opts = parser.parse_args()
 
     issue_cls = Issues(opts.json_report, opts.show_all)
+    # Only keep hold of the issues if we're going to dump them
+    want_list = bool(opts.output)
     issues = []
-    for issue in sorted(issue_cls, key=lambda i: make_key(i)):
-        print(format_issue(issue))
-        issues.append(issue)
+    issues_count = 0
+    # Print issues in batches rather than one write per issue
+    lines = []
+    for issue in sorted(issue_cls, key=make_key):
+        lines.append(format_issue(issue) + "\n")
+        if len(lines) >= 1024:
+            sys.stdout.writelines(lines)
+            lines.clear()
+        issues_count += 1
+        if want_list:
+            issues.append(issue)
+    sys.stdout.writelines(lines)
 
     if opts.output:
         # Dump selected issues
-        with open(opts.output, "wt") as fd:
-            fd.write(json.dumps(issues))
+        with open(opts.output, "wb") as fd:
+            dump_issues(fd, issues)
 
     if opts.totals:
         with open(opts.totals, "wt") as fd:
             fd.write(TOTALS_FORMAT.format_map(issue_cls.totals))
 
-    sys.exit(int(len(issues) > 0))
+    sys.exit(int(issues_count > 0))